@@ -0,0 +1,170 @@
+"""
+Autotuning of the implementations of the model stages.
+
+Which implementation is fastest depends on the input size and the machine: The retina Gaussians
+can be convolved with separable 1d passes or via FFT, the Gabor filters of the simple cells via
+FFT, overlap-add or direct convolution, and all FFTs can use one or several threads. On first
+use for a machine and class of input shapes, all combinations are micro-benchmarked on a random
+input of that shape. The fastest settings are stored in a JSON profile and reused afterwards.
+
+The profile is stored in ~/.cache/domijan2015/autotune.json or in the file given by the
+environment variable DOMIJAN2015_PROFILE. Entries are keyed by the host name, so that a profile
+in a shared home directory can serve several machines.
+
+Usage:
+    output = main.main(stimulus, backend="autotune")
+"""
+
+import json
+import os
+import platform
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+import numpy as np
+import scipy.fft
+
+from . import retina, boundary_detection
+
+# Implementations of the model stages (see retina.gaussian_filters and
+# boundary_detection.get_simple_cells) and numbers of FFT threads:
+CANDIDATES = {"retina": ("separable", "fft"),
+              "simple_cells": ("fft", "oa", "direct"),
+              "workers": tuple(sorted({1, os.cpu_count() or 1}))}
+
+# Tuned settings of this process (see backend):
+profile_cache = {}
+
+
+def profile_path():
+    return os.environ.get("DOMIJAN2015_PROFILE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "domijan2015",
+                                       "autotune.json"))
+
+
+def machine_key():
+    return "%s-%s-%d" % (platform.node(), platform.machine(), os.cpu_count() or 1)
+
+
+def shape_class(shape):
+    """
+    Inputs are grouped by rounding their height and width up to powers of two
+    """
+    return "x".join(str(2 ** int(np.ceil(np.log2(max(n, 1))))) for n in shape)
+
+
+def benchmark(func, repeats=3):
+    """
+    Minimum run time of func in seconds (after one warm-up run)
+    """
+    func()
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def tune(shape, repeats=3):
+    """
+    Micro-benchmark all implementations of the model stages on a random input image of the given
+    shape (padded input of retina.run). Returns the fastest settings (see main.precompute).
+    """
+    rng = np.random.default_rng(0)
+    input_image = rng.uniform(1., 9., shape)
+    c_ON, c_OFF, _, _ = retina.run(input_image, 0)
+
+    results = []
+    for workers in CANDIDATES["workers"]:
+        with scipy.fft.set_workers(workers):
+            settings, total = {"workers": workers}, 0.
+            for stage, func in (("retina", lambda m: retina.run(input_image, 0, m)),
+                                ("simple_cells", lambda m: boundary_detection.get_simple_cells(
+                                    c_ON, c_OFF, boundary_detection.K, m))):
+                times = {m: benchmark(lambda: func(m), repeats) for m in CANDIDATES[stage]}
+                settings[stage] = min(times, key=times.get)
+                total += times[settings[stage]]
+        results.append((total, settings))
+    return min(results, key=lambda res: res[0])[1]
+
+
+def load_profile(path):
+    """
+    Load the profile. A missing or unreadable profile is treated as empty, so that the settings
+    are tuned again and the file is rewritten.
+    """
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return profile if isinstance(profile, dict) else {}
+
+
+def save_profile(path, profile):
+    """
+    Write the profile atomically via a unique temporary file in the same directory
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(profile, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+@contextmanager
+def profile_lock(path):
+    """
+    Exclusive lock of the profile across processes (via the file path + ".lock")
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def update_profile(path, key, shape_key, settings):
+    """
+    Add settings to the profile. Other processes may have updated it in the meantime, so the
+    profile is reloaded and merged while holding the lock.
+    """
+    with profile_lock(path):
+        profile = load_profile(path)
+        profile.setdefault(key, {})[shape_key] = settings
+        save_profile(path, profile)
+
+
+def backend(shape, path=None):
+    """
+    Tuned settings of the model stages for padded input images of the given shape (see
+    main.precompute). The settings are benchmarked on first use for this machine and shape class
+    and stored in the profile file.
+    """
+    path = profile_path() if path is None else path
+    key = (path, machine_key(), shape_class(shape))
+    if key not in profile_cache:
+        profile = load_profile(path)
+        settings = profile.get(key[1], {}).get(key[2])
+        if settings is None:
+            settings = tune(shape)
+            update_profile(path, key[1], key[2], settings)
+        profile_cache[key] = settings
+    return profile_cache[key]
@@ -1,7 +1,8 @@
 import numpy as np
-from scipy.signal import fftconvolve
-from scipy.ndimage import maximum_filter as max_filt
+from scipy.signal import fftconvolve, oaconvolve
+from scipy.ndimage import maximum_filter as max_filt, convolve
 import copy
+from functools import lru_cache
 
 if __package__ is None or __package__ == "":
     import utils
@@ -9,6 +10,21 @@ else:
     from . import utils
 
 
+# Parameters simple and complex cells:
+K = 12   # Number of orientations (only two of them are currently used)
+gabor_size = 21   # Size of the Gabor filters in pixels
+
+# Parameters LBD and GBD:
+L = 4    # Influences range of "horizontal connections" (Drazen: L=4, Paper: not given)
+P = 15   # Elongation of the extra-classical RF in preferred ori (Drazen: P=15, Paper: P=10)
+Q = 5    # Elongation of the extra-classical RF in orthogonal ori (Drazen: Q=5, Paper: Q=4)
+GBD_steps = 20   # Number of recurrent steps of the global boundary detection
+
+# Results of the Boundary Contour System (see BCS):
+BCS_OUTPUTS = ("R", "R_sparse", "R_h", "R_v", "LBD_h", "LBD_v", "GBD_h", "GBD_v")
+
+
+@lru_cache(maxsize=None)
 def get_gabor(size, k, K, sigma1=1.5, sigma2=0.5, G=1, H=0.5):
     """
     size: size of the filter in pixels
@@ -17,6 +33,7 @@ def get_gabor(size, k, K, sigma1=1.5, sigma2=0.5, G=1, H=0.5):
     sigma2: Width of the filter in the orthogonal orientation
     G: Constant that scales the Gabor amplitude
     H: Controls the frequency of the filter's sinusoidal modulation
+    NOTE: Filters are cached, so the returned arrays must not be modified
     """
 
     rec = np.floor(size / 2.)
@@ -29,10 +46,41 @@ def get_gabor(size, k, K, sigma1=1.5, sigma2=0.5, G=1, H=0.5):
     return utils.threshold(Gabor), utils.threshold(-Gabor)
 
 
-def get_simple_cells(c_ON, c_OFF, K):
+def simple_cell(ON, OFF, k, K, method="fft"):
+    """
+    Output of the simple cortical cells with orientation k (see get_simple_cells)
+    ON/OFF: differences of the contrast pathways (c_ON - c_OFF and c_OFF - c_ON)
+    """
+    # Threshold that removes weak and noisy boundary responses (simple cell)
+    T_1 = 0.05
+
+    gaborp, gaborm = get_gabor(gabor_size, k, K)
+
+    # The simple node is sensitive to contrast polarity thus it has two
+    # lobes with opposite polarities (here: A and B)
+    if method == "fft":
+        A_temp = np.rot90(fftconvolve(np.rot90(ON, 2), np.rot90(gaborp, 2), mode='same'), 2)
+        B_temp = np.rot90(fftconvolve(np.rot90(OFF, 2), np.rot90(gaborm, 2), mode='same'), 2)
+    elif method == "oa":
+        A_temp = oaconvolve(ON, gaborp, mode='same')
+        B_temp = oaconvolve(OFF, gaborm, mode='same')
+    elif method == "direct":
+        A_temp = convolve(ON, gaborp, mode='constant')
+        B_temp = convolve(OFF, gaborm, mode='constant')
+    else:
+        raise ValueError("Unknown convolution method: %s" % method)
+    A = utils.threshold(A_temp)
+    B = utils.threshold(B_temp)
+
+    # # Simple cell output:
+    return utils.threshold((A + B) - np.abs(A - B) - T_1)
+
+
+def get_simple_cells(c_ON, c_OFF, K, method="fft"):
     """
     c_ON/c_OFF: output off contrast pathways ON/OFF
     K: number of orientations
+    method: convolution method, "fft", "oa" (overlap-add) or "direct"
     """
 
     ON = c_ON - c_OFF
@@ -41,25 +89,26 @@ def get_simple_cells(c_ON, c_OFF, K):
 
     # Output variables for simple and complex cells with K orientations:
     simple_out = np.zeros([M, N, K])
-    # Threshold that removes weak and noisy boundary responses (simple cell)
-    T_1 = 0.05
 
     # Create output of simple cortical cells:
     # NOTE: only horizontal (k=0) and vertical (k=3) orientations were used:
     for k in range(0, K, 3):
-        gaborp, gaborm = get_gabor(21, k, K)
+        simple_out[:, :, k - 1] = simple_cell(ON, OFF, k, K, method)
 
-        # The simple node is sensitive to contrast polarity thus it has two
-        # lobes with opposite polarities (here: A and B)
-        A_temp = np.rot90(fftconvolve(np.rot90(ON, 2), np.rot90(gaborp, 2), mode='same'), 2)
-        A = utils.threshold(A_temp)
-        B_temp = np.rot90(fftconvolve(np.rot90(OFF, 2), np.rot90(gaborm, 2), mode='same'), 2)
-        B = utils.threshold(B_temp)
+    return simple_out
 
-        # # Simple cell output:
-        simple_out[:, :, k - 1] = utils.threshold((A + B) - np.abs(A - B) - T_1)
 
-    return simple_out
+def boundary_complex_cells(c_ON, c_OFF, method="fft"):
+    """
+    Horizontal and vertical complex cells (channels 5 and 2 of get_complex_cells), which are the
+    only ones used by the LBD. Computed without the K-channel arrays of all orientations.
+    """
+    ON = c_ON - c_OFF
+    OFF = c_OFF - c_ON
+    # Simple cells k and k + K/2 have opposite contrast polarities (see get_simple_cells):
+    complex_h = simple_cell(ON, OFF, 6, K, method) + simple_cell(ON, OFF, 0, K, method)
+    complex_v = simple_cell(ON, OFF, 3, K, method) + simple_cell(ON, OFF, 9, K, method)
+    return complex_h, complex_v
 
 
 def get_complex_cells(simple_out):
@@ -76,34 +125,57 @@ def get_complex_cells(simple_out):
     return complex_out
 
 
+def region_max_filter(x, mask, rows, cols, size, steps=1, offset=(0, 0)):
+    """
+    (Recurrent) MAX function of the local and global boundary detection: In each step, the
+    maximum filter is applied to the region x[rows[0]:rows[1], cols[0]:cols[1]] (the remaining
+    units keep their initial values) and the result is multiplied by mask.
+    x, mask: padded input and mask
+    size: size of the maximum filter
+    steps: number of recurrent steps
+    offset: position of x in the padded array if x is only a window of it (see incremental).
+            Results are then only valid for units which are further than steps times the filter
+            radius away from the edges of the window (unless they coincide with the array edges).
+    """
+    r0, r1 = [min(max(r - offset[0], 0), x.shape[0]) for r in rows]
+    c0, c1 = [min(max(c - offset[1], 0), x.shape[1]) for c in cols]
+    out = copy.deepcopy(x)
+    for t in range(steps):
+        if r1 > r0 and c1 > c0:
+            out[r0:r1, c0:c1] = max_filt(x[r0:r1, c0:c1], size=size)
+        x = mask * out
+    return x
+
+
 def LBD(complex_out, L, P):
     """
     Local boundary detection. For description, see paper.
     """
-    M, N, K = complex_out.shape
+    return local_boundaries(complex_out[:, :, 5], complex_out[:, :, 2], L, P)
+
+
+def local_boundaries(complex_h, complex_v, L, P):
+    """
+    Local boundary detection on the horizontal and vertical complex cells (see LBD)
+    """
+    M, N = complex_h.shape
 
     # Prepare computation of MAX function: horizontal outputs
     LBD_h = np.zeros([M + 2 * P, N + 2 * P])
-    LBD_h[P:M + P, P:N + P] = complex_out[:, :, 5]
-    mask_h = utils.heaviside(LBD_h)
-    temp_h = LBD_h
+    LBD_h[P:M + P, P:N + P] = complex_h
 
     # Prepare computation of MAX function: vertical outputs
     LBD_v = np.zeros([M + 2 * P, N + 2 * P])
-    LBD_v[P:M + P, P:N + P] = complex_out[:, :, 2]
-    mask_v = utils.heaviside(LBD_v)
-    temp_v = LBD_v
+    LBD_v[P:M + P, P:N + P] = complex_v
 
     # Compute MAX function among L nearest neighbors:
     # ... for horizontal outputs:
-    LBD_h_temp = LBD_h
-    LBD_h_temp[L-1:M+L+2, 0:N+L+L+1] = max_filt(temp_h[L-1:M+L+2, 0:N+L+L+1], size=(3, L*2+1))
-    LBD_h = mask_h * LBD_h_temp
+    LBD_h = region_max_filter(LBD_h, utils.heaviside(LBD_h), (L-1, M+L+2), (0, N+L+L+1),
+                              size=(3, L*2+1))
 
     # ... for vertical outputs:
-    LBD_v_temp = LBD_v
-    LBD_v_temp[0:M+L+L+1, L-1:N+L+2] = max_filt(temp_v[0:M+L+L+1, L-1:N+L+2], size=(L*2+1, 3))
-    LBD_v = mask_v * LBD_v_temp
+    LBD_v = region_max_filter(LBD_v, utils.heaviside(LBD_v), (0, M+L+L+1), (L-1, N+L+2),
+                              size=(L*2+1, 3))
 
     return LBD_h, LBD_v
 
@@ -115,93 +187,113 @@ def GBD(LBD_h, LBD_v, P, Q):
     M, N = LBD_h.shape
     M, N = M - 2*P, N - 2*P
 
-    # Prepare variables for recurrent MAX function: horizontal
-    temp2_h = LBD_h
-    GBD_h = copy.deepcopy(LBD_h)
-    mask2_h = utils.heaviside(LBD_h)
-    GBD_h_temp = GBD_h
-
-    # Prepare variables for recurrent MAX function: vertical
-    temp2_v = LBD_v
-    GBD_v = copy.deepcopy(LBD_v)
-    mask2_v = utils.heaviside(LBD_v)
-    GBD_v_temp = GBD_v
-
     # Recurrent computation of max function for GBD:
-    GBD_steps = 20
-    for t in range(GBD_steps):
-        # ... for horizontal outputs
-        GBD_h_temp[P-Q:M+P+Q+1, 0:N+P+P+1] = max_filt(temp2_h[P-Q:M+P+Q+1, 0:N+P+P+1],
-                                                      size=(Q*2+1, P*2+1))
-        GBD_h = mask2_h * GBD_h_temp
-        temp2_h = GBD_h
-
-        # ... for vertical outputs
-        GBD_v_temp[0:M+P+P+1, P-Q:N+P+Q+1] = max_filt(temp2_v[0:M+P+P+1, P-Q:N+P+Q+1],
-                                                      size=(P*2+1, Q*2+1))
-        GBD_v = mask2_v * GBD_v_temp
-        temp2_v = GBD_v
+    # ... for horizontal outputs
+    GBD_h = region_max_filter(LBD_h, utils.heaviside(LBD_h), (P-Q, M+P+Q+1), (0, N+P+P+1),
+                              size=(Q*2+1, P*2+1), steps=GBD_steps)
+
+    # ... for vertical outputs
+    GBD_v = region_max_filter(LBD_v, utils.heaviside(LBD_v), (0, M+P+P+1), (P-Q, N+P+Q+1),
+                              size=(P*2+1, Q*2+1), steps=GBD_steps)
 
     return GBD_h, GBD_v
 
 
-def LBD_GBD_interaction(LBD_h, LBD_v, GBD_h, GBD_v, T_r, F, P, extensive=False):
+def LBD_GBD_interaction(LBD_h, LBD_v, GBD_h, GBD_v, T_r, F, P, extensive=False, dense=True):
     """
     Interaction between local and global boundary detection outputs. For description, see paper.
+    T_r and F can be given with an additional leading parameter axis (see utils.parameter_axis)
+    dense: if False, only the sparse output R_sparse is returned (see sparse_boundary)
     """
     M, N = LBD_h.shape
     M, N = M - 2 * P, N - 2 * P
 
-    # Combine and binarize LBD and GBD outputs:
-    R_h = utils.heaviside((LBD_h / (F + GBD_h)) - T_r)
-    R_v = utils.heaviside((LBD_v / (F + GBD_v)) - T_r)
-
-    # Add vertical and horizontal component:
-    R_full = R_h + R_v
-
-    # Reduce output size to remove some background:
-    R = R_full[P:M + P, P:N + P]
     if extensive:
-        return{"R": R, "R_h": R_h, "R_v": R_v}
-    else:
-        return {"R": R}
+        # Combine and binarize LBD and GBD outputs:
+        R_h = utils.heaviside((LBD_h / (F + GBD_h)) - T_r)
+        R_v = utils.heaviside((LBD_v / (F + GBD_v)) - T_r)
+
+        # Add vertical and horizontal component:
+        R_full = R_h + R_v
+
+        # Reduce output size to remove some background:
+        R = R_full[..., P:M + P, P:N + P]
+        return {"R": R, "R_sparse": sparse_boundary(R), "R_h": R_h, "R_v": R_v}
+
+    # Otherwise, binarize only the reduced outputs and emit the boundary pixels directly from
+    # the boolean masks, without the dense float maps:
+    crop = (slice(P, M + P), slice(P, N + P))
+    R_h = (LBD_h[crop] / (F + GBD_h[crop])) - T_r > 0
+    R_v = (LBD_v[crop] / (F + GBD_v[crop])) - T_r > 0
+    indices = np.flatnonzero(R_h | R_v)
+    values = R_h.ravel()[indices] + R_v.ravel()[indices].astype(float)
+    R_sparse = {"shape": R_h.shape, "indices": indices, "values": values}
+    if dense:
+        return {"R": dense_boundary(R_sparse), "R_sparse": R_sparse}
+    return {"R_sparse": R_sparse}
+
+
+def sparse_boundary(R):
+    """
+    Compact coordinate-list representation of the BCS output R. Only a small fraction of pixels
+    are boundary pixels, so we only store the (sorted) flat indices and values of non-zero pixels.
+    Note: R can be 2 where horizontal and vertical boundaries coincide.
+    """
+    indices = np.flatnonzero(R)
+    return {"shape": R.shape, "indices": indices, "values": R.ravel()[indices]}
 
 
-def BCS(c_ON, c_OFF, extensive=False):
+def dense_boundary(R_sparse):
     """
-    Function that generates output of the whole Boundary Contour System using the functions
-    described above.
+    Convert the sparse boundary representation back into a dense array
     """
+    R = np.zeros(R_sparse["shape"])
+    R.ravel()[R_sparse["indices"]] = R_sparse["values"]
+    return R
 
-    # Parameters simple and complex cells:
-    K = 12   # Number of orientations (only two of them are currently used)
-    simple_out = get_simple_cells(c_ON, c_OFF, K)
-    complex_out = get_complex_cells(simple_out)
 
-    # Parameters LBD and GBD:
-    L = 4    # Influences range of "horizontal connections" (Drazen: L=4, Paper: not given)
-    P = 15   # Elongation of the extra-classical RF in preferred ori (Drazen: P=15, Paper: P=10)
-    Q = 5    # Elongation of the extra-classical RF in orthogonal ori (Drazen: Q=5, Paper: Q=4)
+def boundary_maps(c_ON, c_OFF, method="fft"):
+    """
+    Function that generates the padded local and global boundary detection outputs, i.e. all
+    stages of the Boundary Contour System which do not depend on T_r and F.
+    method: convolution method of the simple cells (see get_simple_cells)
+    """
 
-    LBD_h, LBD_v = LBD(complex_out, L, P)
+    complex_h, complex_v = boundary_complex_cells(c_ON, c_OFF, method)
+    LBD_h, LBD_v = local_boundaries(complex_h, complex_v, L, P)
+    del complex_h, complex_v
     GBD_h, GBD_v = GBD(LBD_h, LBD_v, P, Q)
+    return LBD_h, LBD_v, GBD_h, GBD_v
 
-    # Parameters LBD/GBD-interaction:
-    T_r = 0.6      # Suppresses L/G Interaction output where their ratio is less than 1
-    F = 0.01       # Controls the precision of the ratio computation
-
-    lgi_res = LBD_GBD_interaction(LBD_h, LBD_v, GBD_h, GBD_v, T_r, F, P, extensive=extensive)
-    R = lgi_res["R"]
 
-    if extensive:
-        output = {"R": R,
-                  "R_h": lgi_res["R_h"],
-                  "R_v": lgi_res["R_v"],
-                  "LBD_h": LBD_h,
-                  "LBD_v": LBD_v,
-                  "GBD_h": GBD_h,
-                  "GBD_v": GBD_v}
-    else:
-        output = {"R": R}
-
-    return output
+def BCS(c_ON, c_OFF, extensive=False, T_r=0.6, F=0.01, maps=None, outputs=None):
+    """
+    Function that generates output of the whole Boundary Contour System using the functions
+    described above.
+    T_r: Suppresses L/G Interaction output where their ratio is less than 1
+    F: Controls the precision of the ratio computation
+    maps: precomputed output of boundary_maps (e.g. to reuse it for several values of T_r and F)
+    outputs: names of the results that should be returned (see BCS_OUTPUTS), e.g. ["R_sparse"]
+             to skip the dense R. Defaults to all of them if extensive, else R and R_sparse.
+    T_r and F can be given with an additional leading parameter axis (see utils.parameter_axis).
+    Only the LBD/GBD-interaction is then evaluated for all parameter sets.
+    """
+    if outputs is None:
+        outputs = BCS_OUTPUTS if extensive else ("R", "R_sparse")
+    unknown = set(outputs) - set(BCS_OUTPUTS)
+    if unknown:
+        raise ValueError("Unknown outputs: %s" % sorted(unknown))
+
+    if maps is None:
+        maps = boundary_maps(c_ON, c_OFF)
+    LBD_h, LBD_v, GBD_h, GBD_v = maps
+    output = {"LBD_h": LBD_h, "LBD_v": LBD_v, "GBD_h": GBD_h, "GBD_v": GBD_v}
+
+    if {"R", "R_sparse", "R_h", "R_v"} & set(outputs):
+        # The LBD and GBD outputs are padded by P on each side:
+        P = (LBD_h.shape[0] - c_ON.shape[0]) // 2
+        output.update(LBD_GBD_interaction(LBD_h, LBD_v, GBD_h, GBD_v, T_r, F, P,
+                                          extensive=bool({"R_h", "R_v"} & set(outputs)),
+                                          dense="R" in outputs))
+
+    return {key: output[key] for key in BCS_OUTPUTS if key in outputs}
@@ -0,0 +1,195 @@
+"""
+Fitting of the model parameters to brightness matching data.
+
+The fitted parameters (w1, w2, T_r, F, eps, T_f) only affect the late model stages. The retina and
+the local and global boundary detection are therefore computed only once per stimulus and worker
+(see main.precompute). The objective is minimized with scipy's derivative-free differential
+evolution whose population is evaluated in parallel across processes. All evaluations are stored
+in a checkpoint file, so that an interrupted fit can be resumed: With the same seed, the optimizer
+retraces its previous path from the stored evaluations and continues where it stopped.
+"""
+
+import hashlib
+import json
+import os
+import multiprocessing
+
+import numpy as np
+from scipy.optimize import differential_evolution
+
+from . import main, utils
+
+# Parameters that can be fitted and their default search ranges:
+BOUNDS = {"w1": (0.5, 6.), "w2": (0.1, 3.), "T_r": (0.2, 1.), "F": (0.001, 0.1),
+          "eps": (1., 50.), "T_f": (1., 6.)}
+
+# State of each worker process (see init_worker):
+worker_state = {}
+
+
+def init_worker(stimuli, regions, targets, names, options):
+    """
+    Precompute the parameter-independent model stages for all stimuli once per worker
+    """
+    worker_state["precomputed"] = [main.precompute(stim, options.get("S", 20)) for stim in stimuli]
+    worker_state["stimuli"] = stimuli
+    worker_state["masks"] = [[utils.region_mask(stim.shape, reg) for reg in regs]
+                             for stim, regs in zip(stimuli, regions)]
+    worker_state["targets"] = np.concatenate([np.ravel(t) for t in targets]).astype(float)
+    worker_state["names"] = names
+    worker_state["options"] = {k: v for k, v in options.items() if k != "S"}
+
+
+def predict(x):
+    """
+    Mean model output in all target regions for the parameter values x
+    """
+    params = dict(zip(worker_state["names"], x))
+    predictions = []
+    for stim, pre, masks in zip(worker_state["stimuli"], worker_state["precomputed"],
+                                worker_state["masks"]):
+        output = main.main(stim, precomputed=pre, **params, **worker_state["options"])
+        predictions += [output["model_output"][mask].mean() for mask in masks]
+    return np.array(predictions)
+
+
+def evaluate(x, affine=True):
+    """
+    Sum of squared errors between the predicted and target brightness values. If affine is True,
+    the predictions are first mapped onto the targets by the best fitting linear function, since
+    the model output is normalized.
+    """
+    pred = predict(x)
+    targets = worker_state["targets"]
+    if affine:
+        A = np.stack([pred, np.ones_like(pred)], axis=1)
+        coef = np.linalg.lstsq(A, targets, rcond=None)[0]
+        pred = A @ coef
+    return float(np.sum((pred - targets) ** 2))
+
+
+def fingerprint(stimuli, regions, targets, params, bounds, affine, seed, options):
+    """
+    Hash of everything that determines the losses stored in a checkpoint, so that a checkpoint
+    is only resumed for the same fitting problem
+    """
+    h = hashlib.sha256()
+    for stim, regs, t in zip(stimuli, regions, targets):
+        for array in [stim] + [utils.region_mask(stim.shape, reg) for reg in regs] + [t]:
+            array = np.ascontiguousarray(array, dtype=float)
+            h.update(repr(array.shape).encode())
+            h.update(array.tobytes())
+    h.update(json.dumps({"params": list(params), "bounds": [list(bounds[name]) for name in params],
+                         "affine": affine, "seed": seed, "options": options},
+                        sort_keys=True, default=repr).encode())
+    return h.hexdigest()
+
+
+class CachedMap:
+    """
+    Map function for differential_evolution which only evaluates parameter values that are not
+    yet in the checkpoint, using a process pool if given
+    problem: fingerprint of the fitting problem. A checkpoint of a different problem is rejected.
+    """
+
+    def __init__(self, affine, pool=None, checkpoint=None, problem=None):
+        self.affine = affine
+        self.pool = pool
+        self.checkpoint = checkpoint
+        self.problem = problem
+        self.cache = {}
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                data = json.load(f)
+            if data.get("problem") != problem:
+                raise ValueError("Checkpoint %s belongs to a different fitting problem"
+                                 % checkpoint)
+            self.cache = {tuple(x): loss for x, loss in data["evaluations"]}
+
+    def __call__(self, func, xs):
+        xs = [tuple(float(v) for v in x) for x in xs]
+        new = [x for x in dict.fromkeys(xs) if x not in self.cache]
+        if new:
+            args = [(x, self.affine) for x in new]
+            if self.pool is None:
+                losses = [evaluate(*arg) for arg in args]
+            else:
+                losses = self.pool.starmap(evaluate, args)
+            self.cache.update(zip(new, losses))
+            self.save()
+        return [self.cache[x] for x in xs]
+
+    def save(self):
+        if self.checkpoint is None:
+            return
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"problem": self.problem,
+                       "evaluations": [[list(x), loss] for x, loss in self.cache.items()]}, f)
+        os.replace(tmp, self.checkpoint)
+
+
+def fit(stimuli, regions, targets, params=("w1", "w2", "eps"), bounds=None, affine=True,
+        workers=1, checkpoint=None, maxiter=50, popsize=15, seed=0, **options):
+    """
+    Fit model parameters to target brightness values
+
+    Parameters
+    -----------
+    stimuli : list of 2d arrays
+        stimuli, e.g. created with utils.generate_input
+    regions : list of lists
+        target regions for each stimulus, given as boolean masks or boxes
+        (row_start, row_stop, col_start, col_stop) in stimulus coordinates
+    targets : list of lists
+        target brightness values for each region
+    params : tuple of str
+        names of the parameters that should be fitted (see BOUNDS)
+    bounds : dict
+        search ranges that override BOUNDS
+    affine : bool
+        if True, the model output is linearly mapped onto the targets before computing the error
+    workers : int
+        number of processes that evaluate the objective in parallel
+    checkpoint : str
+        path of a JSON file in which all evaluations are stored and from which a fit is resumed.
+        Raises ValueError if the checkpoint was written for a different problem (stimuli,
+        regions, targets, params, bounds, affine, seed or options).
+    maxiter, popsize, seed :
+        settings of scipy.optimize.differential_evolution
+    options :
+        further keyword arguments for main.main (e.g. S or fill_in_method)
+
+    Returns
+    -----------
+    {"params": best parameter values, "loss": best loss, "result": scipy OptimizeResult}
+    """
+    unknown = set(params) - set(BOUNDS)
+    if unknown:
+        raise ValueError("Parameters cannot be fitted: %s" % sorted(unknown))
+    if not len(stimuli) == len(regions) == len(targets):
+        raise ValueError("Need regions and targets for every stimulus")
+    bounds = {**BOUNDS, **(bounds or {})}
+    stimuli = [np.asarray(stim, dtype=float) for stim in stimuli]
+    init_args = (stimuli, regions, targets, tuple(params), dict(options, crop=True))
+
+    # Check the checkpoint before the (costly) precomputation:
+    problem = fingerprint(stimuli, regions, targets, params, bounds, affine, seed, options)
+    cached_map = CachedMap(affine, checkpoint=checkpoint, problem=problem)
+
+    init_worker(*init_args)
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=init_args)
+        cached_map.pool = pool
+    try:
+        result = differential_evolution(
+            evaluate, [bounds[name] for name in params], args=(affine,), workers=cached_map,
+            updating="deferred", maxiter=maxiter, popsize=popsize, seed=seed, polish=False)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return {"params": dict(zip(params, result.x.tolist())), "loss": float(result.fun),
+            "result": result}
@@ -13,10 +13,76 @@ For more details, see functions.py
 @author: lynn schmittwilken
 """
 
-from . import utils, retina, boundary_detection, filling_in
+import numpy as np
+import scipy.fft
 
+from . import utils, retina, boundary_detection, filling_in, autotune
 
-def main(stimulus, S=20, extensive=False, crop=True):
+# Intermediate results returned with extensive=True (see main). The BCS output "R" can be
+# requested additionally.
+OUTPUTS = ("c_ON", "c_OFF", "l_ON", "l_OFF", "M_ON", "M_OFF", "R_h", "R_v", "model_output",
+           "LBD_h", "LBD_v", "GBD_h", "GBD_v")
+
+
+def precompute(stimulus, S=20, backend=None, boundary=True):
+    """
+    Run all model stages which do not depend on the parameters w1, w2, T_r, F, eps and T_f,
+    i.e. the retina and the local and global boundary detection.
+    backend: implementations of these stages, given as dict with the convolution methods of
+             "retina" (see retina.gaussian_filters) and "simple_cells" (see
+             boundary_detection.get_simple_cells) and the number of FFT threads "workers".
+             If "autotune", use the fastest settings for this machine and input size (see
+             autotune.backend).
+    boundary: if False, skip the local and global boundary detection
+
+    Returns
+    -----------
+    dict that can be passed to main() as precomputed to skip these stages
+    """
+    input_image = utils.add_surround(stimulus, S)
+    if backend == "autotune":
+        backend = autotune.backend(input_image.shape)
+    backend = backend or {}
+
+    with scipy.fft.set_workers(backend.get("workers", 1)):
+        # Extract contrast and luminance information:
+        c_ON, c_OFF, l_ON, l_OFF = retina.run(input_image, int(S / 2), backend.get("retina"))
+
+        # Local and global boundary detection:
+        maps = None
+        if boundary:
+            maps = boundary_detection.boundary_maps(c_ON, c_OFF,
+                                                    backend.get("simple_cells", "fft"))
+
+    return {"S": S, "c_ON": c_ON, "c_OFF": c_OFF, "l_ON": l_ON, "l_OFF": l_OFF,
+            "boundary_maps": maps}
+
+
+def filling_in_inputs(precomputed, w1, w2, T_r, F, extensive=False, outputs=None):
+    """
+    Compute the inputs of the filling-in stage from the output of precompute(): the combined
+    contrast and luminance signals m_ON/m_OFF and the output of the Boundary Contour System
+    outputs: results of the Boundary Contour System that should be returned (see
+             boundary_detection.BCS)
+    """
+    c_ON, c_OFF = precomputed["c_ON"], precomputed["c_OFF"]
+    l_ON, l_OFF = precomputed["l_ON"], precomputed["l_OFF"]
+
+    # Contrast and luminance integration in the ON channel:
+    m_ON = w1*c_ON + w2*l_ON
+
+    # Contrast and lumiance integration in the OFF channel
+    m_OFF = w1*c_OFF + w2*l_OFF
+
+    # Contour detection and processing:
+    bcs_res = boundary_detection.BCS(c_ON, c_OFF, extensive=extensive, T_r=T_r, F=F,
+                                     maps=precomputed["boundary_maps"], outputs=outputs)
+    return m_ON, m_OFF, bcs_res
+
+
+def main(stimulus, S=20, extensive=False, crop=True, fill_in_method="iterative",
+         w1=3., w2=1., T_r=0.6, F=0.01, eps=10., T_f=3., precomputed=None, backend=None,
+         outputs=None):
     """
     Parameters
     -----------
@@ -29,49 +95,124 @@ def main(stimulus, S=20, extensive=False, crop=True):
         to be able to plot the intermediate results)
     crop : bool
         if True, crop the model output to the input size
+    fill_in_method : str
+        "iterative" (recurrent MAX function, as in the paper), "compartments" (faster labelling
+        of connected compartments, see filling_in.fill_in_compartments) or "pyramid"
+        (coarse-to-fine filling-in for large inputs, see filling_in.fill_in_pyramid)
+    w1, w2 : float or 1d array
+        weights of the contrast and luminance pathways in the ON and OFF channels
+    T_r, F : float or 1d array
+        threshold and precision of the LBD/GBD-interaction (see boundary_detection.BCS)
+    eps, T_f : float or 1d array
+        strength of divisive inhibition at boundaries and threshold for filling-in
+        (see filling_in.fill_in)
+
+    Parameters given as 1d arrays (of equal length P) are evaluated in one vectorized pass
+    along an extra leading parameter axis, sharing all upstream computations. All affected
+    outputs then have shape (P, ...).
+    precomputed : dict
+        output of precompute(stimulus, S) to reuse the parameter-independent stages (e.g. when
+        running the model repeatedly with different parameters). S is then taken from it.
+    backend : dict or str
+        implementations of the parameter-independent stages, e.g. "autotune" (see precompute)
+    outputs : list of str
+        names of the results that should be returned (see OUTPUTS and "R"), e.g. ["R", "GBD_h"].
+        Only the stages required for them are run, and all other intermediate results are
+        released as soon as they are no longer needed. Overrides extensive.
 
     Returns
     -----------
     {"model_output": output image} or {"model_output": output image, <all the intermediate results>}
+    or {name: result for all requested outputs}
     """
-    input_image = utils.add_surround(stimulus, S)
+    if outputs is None:
+        outputs = OUTPUTS if extensive else ("model_output",)
+    unknown = set(outputs) - set(OUTPUTS + ("R",))
+    if unknown:
+        raise ValueError("Unknown outputs: %s" % sorted(unknown))
+    need_fill_in = bool({"model_output", "M_ON", "M_OFF"} & set(outputs))
+    need_bcs = need_fill_in or bool(set(boundary_detection.BCS_OUTPUTS) & set(outputs))
 
-    # Extract contrast and luminance information:
-    c_ON, c_OFF, l_ON, l_OFF = retina.run(input_image, int(S / 2))
+    w1, w2, T_r, F, eps, T_f = utils.parameter_axis(w1, w2, T_r, F, eps, T_f)
+    if precomputed is None:
+        precomputed = precompute(stimulus, S, backend, boundary=need_bcs)
+    S = precomputed["S"]
+    results = {key: precomputed[key] for key in ("c_ON", "c_OFF", "l_ON", "l_OFF")
+               if key in outputs}
 
-    # Contrast and luminance integration in the ON channel:
-    w1 = 3.
-    w2 = 1.
-    m_ON = w1*c_ON + w2*l_ON
+    if need_bcs:
+        bcs_outputs = [key for key in boundary_detection.BCS_OUTPUTS
+                       if key in outputs or (key == "R_sparse" and need_fill_in)]
+        m_ON, m_OFF, bcs_res = filling_in_inputs(precomputed, w1, w2, T_r, F,
+                                                 outputs=bcs_outputs)
+        R_sparse = bcs_res.pop("R_sparse", None)
+        results.update(bcs_res)
+        del bcs_res
 
-    # Contrast and lumiance integration in the OFF channel
-    m_OFF = w1*c_OFF + w2*l_OFF
+    # Release all intermediate results which are not requested before the filling-in:
+    del precomputed
 
-    # Contour detection and processing:
-    bcs_res = boundary_detection.BCS(c_ON, c_OFF, extensive=extensive)
-    R = bcs_res["R"]
-
-    # Filling-in:
-    bright, M_ON, M_OFF = filling_in.fill_in(R, m_ON, m_OFF)
-
-    if crop:
-        bright = utils.remove_surround(bright, int(S/2))
-
-    if extensive:
-        output = {"c_ON": c_ON,
-                  "c_OFF": c_OFF,
-                  "l_ON": l_ON,
-                  "l_OFF": l_OFF,
-                  "M_ON": M_ON,
-                  "M_OFF": M_OFF,
-                  "R_h": bcs_res["R_h"],
-                  "R_v": bcs_res["R_v"],
-                  "model_output": bright,
-                  "LBD_h": bcs_res["LBD_h"],
-                  "LBD_v": bcs_res["LBD_v"],
-                  "GBD_h": bcs_res["GBD_h"],
-                  "GBD_v": bcs_res["GBD_v"]}
-    else:
-        output = {"model_output": bright}
-
-    return output
+    if need_fill_in:
+        # Filling-in (using the compact boundary representation):
+        bright, M_ON, M_OFF = filling_in.fill_in(R_sparse, m_ON, m_OFF, method=fill_in_method,
+                                                eps=eps, T_f=T_f)
+
+        if crop:
+            bright = utils.remove_surround(bright, int(S/2))
+        results.update({"model_output": bright, "M_ON": M_ON, "M_OFF": M_OFF})
+
+    return {key: results[key] for key in OUTPUTS + ("R",) if key in outputs}
+
+
+def query(stimulus, rois, stats=("mean",), normalize=False, S=20, fill_in_method="iterative",
+          w1=3., w2=1., T_r=0.6, F=0.01, eps=10., T_f=3., precomputed=None, backend=None):
+    """
+    Region-of-interest query: summary statistics of the model output in the given regions.
+    Intermediate results and unrequested outputs are not materialized, and the iterative
+    filling-in stops as soon as the regions of interest have converged.
+
+    Parameters
+    -----------
+    stimulus : 2d array
+        stimulus on which the model should be run
+    rois : list
+        regions of interest, given as boolean masks or boxes (row_start, row_stop, col_start,
+        col_stop) in stimulus coordinates (see utils.region_mask)
+    stats : tuple of str
+        summary statistics, any of "mean", "std", "min", "max", "median"
+    normalize : bool
+        if True, the statistics refer to the normalized model output of main(). This requires
+        filling-in to converge in the whole image. If False, the statistics refer to the raw
+        brightness (see filling_in.fill_in), which is an affine function of the model output,
+        and filling-in only needs to converge in the compartments of the regions of interest.
+    other parameters :
+        see main()
+
+    Returns
+    -----------
+    {stat: array of shape ([P,] number of rois)}
+    """
+    unknown = set(stats) - {"mean", "std", "min", "max", "median"}
+    if unknown:
+        raise ValueError("Unknown statistics: %s" % sorted(unknown))
+    masks = [utils.region_mask(stimulus.shape, roi) for roi in rois]
+
+    w1, w2, T_r, F, eps, T_f = utils.parameter_axis(w1, w2, T_r, F, eps, T_f)
+    if precomputed is None:
+        precomputed = precompute(stimulus, S, backend)
+    S = precomputed["S"]
+    m_ON, m_OFF, bcs_res = filling_in_inputs(precomputed, w1, w2, T_r, F, outputs=["R_sparse"])
+
+    # Regions of interest in the coordinates of the filling-in stage (see utils.remove_surround):
+    M, N = stimulus.shape
+    Z = int(S/2) - 1
+    roi = np.zeros(m_ON.shape[-2:], bool)
+    roi[Z:Z+M, Z:Z+N] = np.any(masks, axis=0)
+
+    bright, _, _ = filling_in.fill_in(bcs_res["R_sparse"], m_ON, m_OFF, method=fill_in_method,
+                                      eps=eps, T_f=T_f, roi=roi, normalize=normalize)
+    bright = bright[..., Z:Z+M, Z:Z+N]
+
+    values = [bright[..., mask] for mask in masks]
+    return {stat: np.stack([getattr(np, stat)(v, axis=-1) for v in values], axis=-1)
+            for stat in stats}
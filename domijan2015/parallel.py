@@ -0,0 +1,172 @@
+"""
+Shared-memory execution layer for running the model on batches of stimuli in several processes.
+
+Stimuli and outputs are stored in NumPy arrays backed by multiprocessing.shared_memory. Workers
+read their stimulus from and write model_output (and requested intermediate results) directly
+into these preallocated buffers, so that only small handles and batch indices are passed between
+processes instead of pickled arrays.
+
+Usage:
+    with parallel.SharedBatch(stimuli, outputs=("model_output", "R_h"), crop=False) as batch:
+        batch.run(workers=4)
+        R_h = batch.outputs["R_h"]   # (B, ...) view into shared memory
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from . import main, utils, boundary_detection
+
+# Shared buffers attached by each worker process (see init_worker):
+worker_state = {}
+
+
+def create_shared(shape, dtype=float):
+    """
+    Allocate a NumPy array in shared memory.
+    Returns the array, its SharedMemory block and a small picklable handle (see attach_shared)
+    """
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return array, shm, (shm.name, tuple(shape), dtype.str)
+
+
+def attach_shared(handle):
+    """
+    Attach to a shared array created with create_shared in another process
+    """
+    name, shape, dtype = handle
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def output_shapes(shape, outputs, S=20, crop=True, **options):
+    """
+    Shapes of the requested model outputs for a stimulus of the given shape (see main.main)
+    options: further keyword arguments for main.main. Outputs which depend on parameters that
+             are given as 1d arrays get an additional leading parameter axis.
+    """
+    unknown = set(outputs) - set(main.OUTPUTS + ("R",))
+    if unknown:
+        raise ValueError("Unknown outputs: %s" % sorted(unknown))
+
+    def parameter_shape(*names):
+        params = [options.get(name, 0.) for name in names]
+        utils.parameter_axis(*params)
+        return np.broadcast_shapes(*[np.shape(p) for p in params])
+
+    # The stimulus is padded by S on each side and the retina removes int(S/2) of it again
+    # (see main.precompute). The BCS adds P on each side, the filling-in 1:
+    M, N = shape
+    Z = int(S / 2)
+    retina_shape = (M + 2 * (S - Z), N + 2 * (S - Z))
+    P = boundary_detection.P
+    padded_shape = (retina_shape[0] + 2 * P, retina_shape[1] + 2 * P)
+    bcs_axis = parameter_shape("T_r", "F")
+    fill_in_axis = parameter_shape("w1", "w2", "T_r", "F", "eps", "T_f")
+    output_shape = (retina_shape[0] - 2 * Z, retina_shape[1] - 2 * Z) if crop else retina_shape
+
+    shapes = {"model_output": fill_in_axis + output_shape,
+              "M_ON": fill_in_axis + (retina_shape[0] + 2, retina_shape[1] + 2),
+              "R": bcs_axis + retina_shape,
+              "R_h": bcs_axis + padded_shape}
+    shapes["M_OFF"], shapes["R_v"] = shapes["M_ON"], shapes["R_h"]
+    for key in ("c_ON", "c_OFF", "l_ON", "l_OFF"):
+        shapes[key] = retina_shape
+    for key in ("LBD_h", "LBD_v", "GBD_h", "GBD_v"):
+        shapes[key] = padded_shape
+    return {key: shapes[key] for key in outputs}
+
+
+def init_worker(stimuli_handle, output_handles, options):
+    """
+    Attach the shared buffers once per worker process
+    """
+    worker_state["shm"] = []
+    worker_state["stimuli"], shm = attach_shared(stimuli_handle)
+    worker_state["shm"].append(shm)
+    worker_state["outputs"] = {}
+    for key, handle in output_handles.items():
+        worker_state["outputs"][key], shm = attach_shared(handle)
+        worker_state["shm"].append(shm)
+    worker_state["options"] = options
+
+
+def run_index(i):
+    """
+    Run the model on stimulus i of the shared batch and write the outputs into the shared buffers
+    """
+    outputs = worker_state["outputs"]
+    res = main.main(worker_state["stimuli"][i], **worker_state["options"], outputs=list(outputs))
+    for key, out in outputs.items():
+        out[i] = res[key]
+
+
+class SharedBatch:
+    """
+    Batch of equally-sized stimuli and preallocated model outputs in shared memory
+    stimuli: array of shape (B, M, N) or list of B arrays of shape (M, N)
+    outputs: names of the outputs that should be kept (see main.OUTPUTS)
+    options: further keyword arguments for main.main (e.g. S, crop or parameters)
+    """
+
+    def __init__(self, stimuli, outputs=("model_output",), **options):
+        if "extensive" in options:
+            raise ValueError("Request intermediate results via outputs instead of extensive")
+        stimuli = np.asarray(stimuli, dtype=float)
+        if stimuli.ndim != 3:
+            raise ValueError("Stimuli have to be equally-sized 2d arrays")
+        self.options = options
+        self.blocks = []
+
+        self.stimuli, shm, self.stimuli_handle = create_shared(stimuli.shape)
+        self.blocks.append(shm)
+        self.stimuli[:] = stimuli
+
+        shapes = output_shapes(stimuli.shape[1:], outputs, **options)
+        self.outputs, self.output_handles = {}, {}
+        for key in outputs:
+            self.outputs[key], shm, self.output_handles[key] = create_shared(
+                (len(stimuli),) + shapes[key])
+            self.blocks.append(shm)
+
+    def run(self, workers=None, indices=None):
+        """
+        Run the model on all stimuli (or the given indices) using a pool of worker processes
+        """
+        if indices is None:
+            indices = range(len(self.stimuli))
+        initargs = (self.stimuli_handle, self.output_handles, self.options)
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+            pool.map(run_index, indices, chunksize=1)
+        return self.outputs
+
+    def close(self):
+        """
+        Release the shared memory. Arrays in outputs must not be used afterwards.
+        """
+        self.stimuli = None
+        self.outputs = {}
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_batch(stimuli, workers=None, outputs=("model_output",), **options):
+    """
+    Run the model on a batch of equally-sized stimuli in parallel using shared memory.
+    Returns a dict with a (B, ...) array for each requested output (copied out of shared memory)
+    """
+    with SharedBatch(stimuli, outputs, **options) as batch:
+        batch.run(workers)
+        return {key: np.array(val) for key, val in batch.outputs.items()}
@@ -0,0 +1,175 @@
+"""
+Long-running local model service.
+
+The server keeps the model warm (imports, filter banks, FFT plans) and answers requests over a
+Unix socket. The model is CPU-bound, so requests are run one after another in a single worker
+thread, in the order in which they arrive (FIFO), and each request is answered as soon as its
+stimulus is done. Requests are not combined into batches: The only stage that accepts stacked
+stimuli, the filling-in, is memory-bound and measured slower on stacks than one by one.
+
+Wire format (both directions): a sequence of frames, each consisting of an 8-byte big-endian
+length followed by the payload.
+    request:  [JSON options] [stimulus as .npy]
+    response: [JSON status]  [model_output as .npy] (empty frame if status["ok"] is false)
+
+Usage:
+    python -m domijan2015.server --socket /tmp/domijan2015.sock
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import socket
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import main, utils
+
+# Options that clients are allowed to pass to main.main:
+OPTIONS = ("S", "crop", "fill_in_method")
+HEADER = struct.Struct(">Q")
+
+
+def to_bytes(array):
+    """
+    Serialize a numpy array in .npy format
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def from_bytes(data):
+    """
+    Deserialize a numpy array in .npy format
+    """
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+async def read_frame(reader):
+    (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return await reader.readexactly(size)
+
+
+def write_frame(writer, data):
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+class ModelServer:
+    """
+    Asyncio server that runs the model on the requested stimuli in FIFO order
+    """
+
+    def __init__(self):
+        # The model is CPU-bound, so we run requests one after another in a single worker:
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def warm_up(self):
+        """
+        Run the model once so that all imports, filter banks and FFT plans are initialized
+        """
+        stimulus, _, _ = utils.generate_input(6)
+        main.main(stimulus)
+
+    @staticmethod
+    def run_stimulus(stimulus, options):
+        return main.main(stimulus, **options)["model_output"]
+
+    async def submit(self, stimulus, options):
+        """
+        Queue a stimulus and wait for its output. Requests that are cancelled before they are
+        started (e.g. because their client disconnected) are skipped.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.run_stimulus, stimulus, options)
+
+    async def handle(self, reader, writer):
+        """
+        Answer requests of a single client connection until it is closed
+        """
+        try:
+            while True:
+                try:
+                    options = json.loads(await read_frame(reader))
+                    stimulus = from_bytes(await read_frame(reader))
+                except asyncio.IncompleteReadError:
+                    break
+
+                try:
+                    unknown = set(options) - set(OPTIONS)
+                    if unknown:
+                        raise ValueError("Unknown options: %s" % sorted(unknown))
+                    if stimulus.ndim != 2:
+                        raise ValueError("Stimulus has to be a 2d array")
+                    output = await self.submit(stimulus.astype(float), options)
+                    write_frame(writer, json.dumps({"ok": True}).encode())
+                    write_frame(writer, to_bytes(output))
+                except Exception as error:
+                    write_frame(writer, json.dumps({"ok": False, "error": repr(error)}).encode())
+                    write_frame(writer, b"")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, path):
+        server = await asyncio.start_unix_server(self.handle, path=path)
+        async with server:
+            await server.serve_forever()
+
+
+class Client:
+    """
+    Blocking client for the model server
+    """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def _read_frame(self):
+        (size,) = HEADER.unpack(self._read_exactly(HEADER.size))
+        return self._read_exactly(size)
+
+    def _read_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed by model server")
+            data.extend(chunk)
+        return bytes(data)
+
+    def run(self, stimulus, **options):
+        """
+        Run the model on the server. Accepts the same options as main.main (see OPTIONS) and
+        returns the model output
+        """
+        for data in (json.dumps(options).encode(), to_bytes(np.asarray(stimulus, dtype=float))):
+            self.sock.sendall(HEADER.pack(len(data)) + data)
+        status = json.loads(self._read_frame())
+        output = self._read_frame()
+        if not status["ok"]:
+            raise RuntimeError("Model server error: %s" % status["error"])
+        return from_bytes(output)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Domijan (2015) model as local service")
+    parser.add_argument("--socket", default="/tmp/domijan2015.sock", help="Unix socket path")
+    args = parser.parse_args()
+
+    model_server = ModelServer()
+    model_server.warm_up()
+    asyncio.run(model_server.serve(args.socket))
@@ -319,6 +319,33 @@ def generate_input(a):
     return input_image, name, cut_height
 
 
+def parameter_axis(*params):
+    """
+    Prepare model parameters for vectorized parameter sweeps. Parameters given as 1d array-likes
+    of equal length P are converted into arrays of shape (P, 1, 1) which broadcast along an
+    extra leading parameter axis of the model's 2d maps. Scalar parameters are returned unchanged
+    """
+    shapes = [np.shape(p) for p in params]
+    if any(len(shape) > 1 for shape in shapes):
+        raise ValueError("Parameters have to be scalars or 1d arrays")
+    np.broadcast_shapes(*shapes)
+    return [p if np.ndim(p) == 0 else np.asarray(p, dtype=float).reshape(-1, 1, 1)
+            for p in params]
+
+
+def region_mask(shape, region):
+    """
+    Convert a region into a boolean mask of the given (stimulus) shape. A region is either a
+    boolean mask or a box (row_start, row_stop, col_start, col_stop)
+    """
+    if np.shape(region) == tuple(shape):
+        return np.asarray(region, dtype=bool)
+    r0, r1, c0, c1 = region
+    mask = np.zeros(shape, dtype=bool)
+    mask[r0:r1, c0:c1] = True
+    return mask
+
+
 def add_surround(input_raw, size=10):
     """
     Add mid-gray surround to the image
@@ -333,7 +360,7 @@ def remove_surround(input_raw, size=10):
     """
     Crop image, removing the added surround
     """
-    img = input_raw[size-1:input_raw.shape[0]-size-1, size-1:input_raw.shape[1]-size-1]
+    img = input_raw[..., size-1:input_raw.shape[-2]-size-1, size-1:input_raw.shape[-1]-size-1]
     return img
 
 
@@ -364,3 +391,85 @@ def compare_arrays(img1, img2, threshold=0.01):
     except Exception:
         print("Something went wrong comparing arrays.")
         raise
+
+
+def compare_arrays_batch(imgs1, imgs2, threshold=0.01, reduce="mean"):
+    """
+    Vectorized version of compare_arrays for stacks of equally-sized images given as arrays of
+    shape (B, M, N). threshold can be a scalar or an array of B per-image thresholds.
+    reduce: "mean" compares the mean absolute difference of each image to its threshold (as in
+            compare_arrays), "max" the maximum absolute difference
+    Returns a boolean array of length B
+    """
+    imgs1 = np.asarray(imgs1, dtype=float)
+    imgs2 = np.asarray(imgs2, dtype=float)
+    if imgs1.shape != imgs2.shape:
+        raise ValueError("Cannot compare image stacks of shapes %s and %s"
+                         % (imgs1.shape, imgs2.shape))
+    diff = np.abs(imgs1 - imgs2).reshape(imgs1.shape[0], -1)
+    if reduce == "mean":
+        diff = diff.mean(axis=1)
+    elif reduce == "max":
+        diff = diff.max(axis=1)
+    else:
+        raise ValueError("Unknown reduction: %s" % reduce)
+    return diff <= np.asarray(threshold, dtype=float)
+
+
+def save_reference(fname, outputs, tolerances=None, atol=1e-8):
+    """
+    Save model outputs (e.g. the dict returned by main.main(extensive=True)) as numeric golden
+    reference in a compressed .npz file.
+    tolerances: dict with per-stage thresholds on the maximum absolute difference. Stages without
+    explicit tolerance get atol. The model is deterministic, so outputs only differ by floating
+    point rounding (~1e-14) unless the model has changed.
+    """
+    tolerances = {} if tolerances is None else tolerances
+    stages = sorted(outputs.keys())
+    tols = [tolerances.get(s, atol) for s in stages]
+    arrays = {s: np.asarray(outputs[s], dtype=float) for s in stages}
+    np.savez_compressed(fname, _stages=np.array(stages), _tolerances=np.array(tols), **arrays)
+
+
+def load_reference(fname):
+    """
+    Load a golden reference saved with save_reference.
+    Returns a dict {stage: array} and a dict {stage: tolerance}
+    """
+    with np.load(fname) as data:
+        stages = [str(s) for s in data["_stages"]]
+        tols = dict(zip(stages, data["_tolerances"].tolist()))
+        arrays = {s: data[s] for s in stages}
+    return arrays, tols
+
+
+def compare_to_reference(outputs, fname, stages=None):
+    """
+    Compare model outputs to a golden reference saved with save_reference. Stages of equal shape
+    are compared in one batch, without any rendering.
+    stages: stages to compare (defaults to all stages in the reference)
+    Returns a dict {stage: bool}. Stages missing in outputs do not match their reference.
+    """
+    ref, tols = load_reference(fname)
+    if stages is None:
+        stages = list(ref)
+
+    missing = [s for s in stages if s not in ref]
+    if missing:
+        raise KeyError("Stages missing in reference: %s" % missing)
+
+    # Stages which are missing or whose shape changed cannot match their reference:
+    result = {s: False for s in stages
+              if s not in outputs or np.shape(outputs[s]) != ref[s].shape}
+
+    # Group remaining stages by shape to compare each group in a single vectorized operation:
+    groups = {}
+    for s in stages:
+        if s not in result:
+            groups.setdefault(ref[s].shape, []).append(s)
+
+    for group in groups.values():
+        same = compare_arrays_batch([outputs[s] for s in group], [ref[s] for s in group],
+                                    [tols[s] for s in group], reduce="max")
+        result.update(zip(group, same.tolist()))
+    return result
@@ -0,0 +1,21 @@
+"""
+Regenerates the numeric golden references (Ground_truth/*.npz) used by test_outputs.py.
+Only run this script after intentional changes of the model output.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from domijan2015 import utils, main  # noqa: E402
+from test_outputs import stimlist, ground_truth_dir  # noqa: E402
+
+
+if __name__ == "__main__":
+    for idx, name in stimlist:
+        img, _, _ = utils.generate_input(idx)
+        res = main.main(img, crop=False, extensive=True)
+        fname = os.path.join(ground_truth_dir, name + ".npz")
+        utils.save_reference(fname, res)
+        print("Saved reference: " + fname)
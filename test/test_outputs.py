@@ -1,9 +1,15 @@
 import os
 import sys
+import socket
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PIL import Image
 import pytest
-from domijan2015 import utils, main
+from domijan2015 import (utils, main, retina, boundary_detection, server, fitting, parallel,
+                         incremental, autotune)
 
 current_dir = __file__
 project_path = os.path.abspath(current_dir + "../../../")
@@ -34,3 +40,298 @@ def test_stim(stim):
     output = utils.img_to_png(res['model_output'])
     test_output = np.asarray(Image.open(f"{ground_truth_dir}{stim[1]}.png").convert("L"))
     assert utils.compare_arrays(output, test_output), "outputs are different"
+
+
+@pytest.mark.parametrize("stim", stimlist)
+def test_stim_reference(stim):
+    img, _, _ = utils.generate_input(stim[0])
+    res = main.main(img, crop=False, extensive=True)
+    same = utils.compare_to_reference(res, f"{ground_truth_dir}{stim[1]}.npz")
+    failed = [stage for stage, ok in same.items() if not ok]
+    assert not failed, f"outputs are different in stages: {failed}"
+
+
+def test_reference_sensitivity():
+    img, _, _ = utils.generate_input(1)
+    res = main.main(img, crop=False, extensive=True)
+    fname = f"{ground_truth_dir}dungeon_illusion.npz"
+    res["model_output"][50:60, 50:60] += 0.25
+    res["R_h"].ravel()[np.flatnonzero(res["R_h"])[:40]] = 0.
+    same = utils.compare_to_reference(res, fname, stages=["model_output", "R_h", "R_v"])
+    assert same == {"model_output": False, "R_h": False, "R_v": True}
+
+    # Stages missing in the outputs are reported as well:
+    del res["R_v"]
+    assert not utils.compare_to_reference(res, fname)["R_v"]
+
+
+@pytest.mark.parametrize("stim", stimlist)
+def test_fill_in_compartments(stim):
+    img, _, _ = utils.generate_input(stim[0])
+    res_iter = main.main(img, crop=False, extensive=True)
+    res_comp = main.main(img, crop=False, extensive=True, fill_in_method="compartments")
+    for key in ["M_ON", "M_OFF", "model_output"]:
+        assert np.allclose(res_iter[key], res_comp[key], rtol=0, atol=1e-10), f"{key} differs"
+
+
+@pytest.mark.parametrize("stim", stimlist)
+def test_fill_in_pyramid(stim):
+    img, _, _ = utils.generate_input(stim[0])
+    res_iter = main.main(img, crop=False, extensive=True)
+    res_pyr = main.main(img, crop=False, extensive=True, fill_in_method="pyramid")
+    assert (res_pyr["M_ON"] <= res_iter["M_ON"] + 1e-10).all(), "M_ON is overestimated"
+    assert (res_pyr["M_OFF"] <= res_iter["M_OFF"] + 1e-10).all(), "M_OFF is overestimated"
+    assert utils.compare_arrays(res_pyr["model_output"], res_iter["model_output"], 0.015)
+
+
+def test_fill_in_pyramid_upscaled():
+    img = np.kron(utils.generate_input(6)[0], np.ones((4, 4)))
+    pre = main.precompute(img)
+    outputs = ["model_output", "M_ON", "M_OFF"]
+    res_conv = main.main(img, precomputed=pre, fill_in_method="compartments", outputs=outputs)
+    res_pyr = main.main(img, precomputed=pre, fill_in_method="pyramid", outputs=outputs)
+    assert (res_pyr["M_ON"] <= res_conv["M_ON"] + 1e-10).all(), "M_ON is overestimated"
+    assert (res_pyr["M_OFF"] <= res_conv["M_OFF"] + 1e-10).all(), "M_OFF is overestimated"
+    assert utils.compare_arrays(res_pyr["model_output"], res_conv["model_output"], 0.06)
+
+
+async def shutdown(srv):
+    srv.close()
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires Unix sockets")
+def test_server(tmp_path):
+    path = str(tmp_path / "domijan2015.sock")
+    model_server = server.ModelServer()
+    loop = asyncio.new_event_loop()
+    srv = loop.run_until_complete(asyncio.start_unix_server(model_server.handle, path=path))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def run(img):
+        with server.Client(path) as client:
+            return client.run(img, crop=False)
+
+    try:
+        stims = [utils.generate_input(i)[0] for i in (6, 9)] * 2
+        with ThreadPoolExecutor() as pool:
+            outputs = list(pool.map(run, stims))
+        for img, output in zip(stims, outputs):
+            assert np.array_equal(output, main.main(img, crop=False)["model_output"])
+        with server.Client(path) as client, pytest.raises(RuntimeError):
+            client.run(stims[0], unknown_option=True)
+    finally:
+        asyncio.run_coroutine_threadsafe(shutdown(srv), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_server_latency():
+    # Stimuli with these values block the (mocked) model until their event is set:
+    events = {2.: threading.Event(), 3.: threading.Event()}
+
+    def run_stimulus(stimulus, options):
+        if stimulus[0, 0] in events:
+            events[stimulus[0, 0]].wait(10)
+        return stimulus
+
+    model_server = server.ModelServer()
+    model_server.run_stimulus = run_stimulus
+    img = np.ones((4, 4))
+
+    async def scenario():
+        requests = [asyncio.ensure_future(model_server.submit(val * img, {}))
+                    for val in (2., 1., 3.)]
+        await asyncio.sleep(0.01)
+        assert not any(request.done() for request in requests)
+
+        # Requests are answered in FIFO order, each as soon as its stimulus is done:
+        events[2.].set()
+        assert np.array_equal(await asyncio.wait_for(requests[0], 5), 2. * img)
+        assert np.array_equal(await asyncio.wait_for(requests[1], 5), img)
+        assert not requests[2].done()
+        events[3.].set()
+        assert np.array_equal(await asyncio.wait_for(requests[2], 5), 3. * img)
+
+    asyncio.run(scenario())
+
+
+def test_parameter_sweep():
+    img, _, _ = utils.generate_input(7)
+    sweep = {"eps": [5., 10.], "T_f": [3., 4.], "T_r": [0.6, 0.8], "F": [0.01, 0.1],
+             "w1": [3., 2.], "w2": [1., 2.]}
+    res = main.main(img, extensive=True, **sweep)
+    for i in range(2):
+        res_i = main.main(img, extensive=True, **{key: val[i] for key, val in sweep.items()})
+        for key in ["R_h", "R_v", "M_ON", "M_OFF", "model_output"]:
+            assert np.array_equal(res[key][i], res_i[key]), f"{key} differs"
+
+
+def test_fitting(tmp_path, monkeypatch):
+    img, _, _ = utils.generate_input(6)
+    boxes = [(39, 60, 39, 60), (39, 60, 139, 160)]
+    output = main.main(img, w1=2.5, fill_in_method="compartments")["model_output"]
+    targets = [output[r0:r1, c0:c1].mean() for r0, r1, c0, c1 in boxes]
+    checkpoint = str(tmp_path / "fit.json")
+    kwargs = dict(params=("w1",), affine=False, maxiter=5, popsize=5, checkpoint=checkpoint,
+                  fill_in_method="compartments")
+
+    res = fitting.fit([img], [boxes], [targets], **kwargs)
+    assert abs(res["params"]["w1"] - 2.5) < 0.2
+    # Resuming from the checkpoint should not require new model evaluations:
+    monkeypatch.setattr(fitting, "predict", None)
+    res_resumed = fitting.fit([img], [boxes], [targets], **kwargs)
+    assert res_resumed["params"] == res["params"]
+
+    # A checkpoint of a different problem is not reused:
+    for changed in (dict(targets=[targets[::-1]]), dict(affine=True),
+                    dict(bounds={"w1": (1., 4.)})):
+        args = {"stimuli": [img], "regions": [boxes], "targets": [targets], **kwargs, **changed}
+        with pytest.raises(ValueError):
+            fitting.fit(**args)
+
+
+@pytest.mark.parametrize("stim", stimlist[5:7])
+def test_query(stim):
+    img, _, _ = utils.generate_input(stim[0])
+    rois = [(40, 50, 40, 50), (20, 30, 60, 70), img == 5.]
+    output = main.main(img)["model_output"]
+    res = main.query(img, rois, stats=("mean", "max"), normalize=True)
+    for i, roi in enumerate(rois):
+        mask = utils.region_mask(img.shape, roi)
+        assert res["mean"][i] == output[mask].mean()
+        assert res["max"][i] == output[mask].max()
+
+    # The raw brightness is an affine function of the normalized output:
+    res_raw = main.query(img, rois)
+    coef = np.polyfit(res["mean"], res_raw["mean"], 1)
+    assert np.allclose(np.polyval(coef, res["mean"]), res_raw["mean"])
+
+
+def test_parallel():
+    imgs = [utils.generate_input(i)[0] for i in (7, 8)]
+    keys = ("model_output", "R_h", "M_ON")
+    res = parallel.run_batch(imgs, workers=2, outputs=keys, crop=False)
+    for img, *outputs in zip(imgs, *(res[key] for key in keys)):
+        ref = main.main(img, extensive=True, crop=False)
+        for key, output in zip(keys, outputs):
+            assert np.array_equal(output, ref[key]), f"{key} differs"
+
+    # Parameter sweeps add a leading parameter axis to the outputs:
+    res = parallel.run_batch(imgs, workers=2, outputs=("model_output", "R"), eps=[5., 10.])
+    for img, output, R in zip(imgs, res["model_output"], res["R"]):
+        ref = main.main(img, outputs=("model_output", "R"), eps=[5., 10.])
+        assert np.array_equal(output, ref["model_output"])
+        assert np.array_equal(R, ref["R"])
+
+
+def test_incremental():
+    img, _, _ = utils.generate_input(2)
+    frames = [img]
+    for k in range(3):
+        frame = frames[-1].copy()
+        frame[40:50, 20+30*k:30+30*k] += 0.5
+        frames.append(frame)
+    frames.append(frames[-1])
+    for frame, output in zip(frames, incremental.run_sequence(frames)):
+        assert np.allclose(output, main.main(frame)["model_output"], rtol=0, atol=1e-12)
+
+
+def test_incremental_edit():
+    img, _, _ = utils.generate_input(6)
+    model = incremental.IncrementalModel()
+    model.run(img)
+    for lum in (4., 6.):
+        img[39:60, 39:60] = lum
+        output = model.run(img, region=(39, 60, 39, 60))["model_output"]
+        assert np.allclose(output, main.main(img)["model_output"], rtol=0, atol=1e-12)
+
+
+def test_incremental_upscaled():
+    # At this size, 300 filling-in iterations do not suffice to converge:
+    img = np.kron(utils.generate_input(6)[0], np.ones((4, 4)))
+    model = incremental.IncrementalModel()
+    output = model.run(img)["model_output"]
+    img[5:7, 5:7] = 9.
+    output_edit = model.run(img, region=(5, 7, 5, 7))["model_output"]
+    far = np.ones(img.shape, bool)
+    far[:60, :60] = False
+    assert np.allclose(output_edit[far], output[far], rtol=0, atol=1e-12)
+    ref = main.main(img, fill_in_method="compartments")["model_output"]
+    assert np.allclose(output_edit, ref, rtol=0, atol=1e-12)
+
+
+def test_retina_methods():
+    img, _, _ = utils.generate_input(9)
+    input_image = utils.add_surround(img, 20)
+    outputs = [retina.run(input_image, 10, method) for method in ("separable", "fft")]
+    for out_sep, out_fft in zip(*outputs):
+        assert np.allclose(out_sep, out_fft, rtol=0, atol=1e-12)
+
+
+def test_autotune(tmp_path, monkeypatch):
+    monkeypatch.setenv("DOMIJAN2015_PROFILE", str(tmp_path / "profile.json"))
+    img, _, _ = utils.generate_input(7)
+    output = main.main(img, backend="autotune")["model_output"]
+    assert np.allclose(output, main.main(img)["model_output"], rtol=0, atol=1e-12)
+    profile = autotune.load_profile(str(tmp_path / "profile.json"))
+    settings = profile[autotune.machine_key()]["256x256"]
+    for stage in ("retina", "simple_cells", "workers"):
+        assert settings[stage] in autotune.CANDIDATES[stage]
+
+    # Later runs reuse the stored profile:
+    autotune.profile_cache.clear()
+    monkeypatch.setattr(autotune, "tune", None)
+    assert autotune.backend((140, 140)) == settings
+
+
+def write_profile(args):
+    path, worker = args
+    for i in range(50):
+        autotune.update_profile(path, "host", "%d-%d" % (worker, i), {"workers": 1})
+        # Concurrent writers never leave a partially written profile:
+        profile = autotune.load_profile(path)
+        assert all("%d-%d" % (worker, j) in profile["host"] for j in range(i + 1))
+
+
+def test_autotune_concurrent(tmp_path):
+    path = str(tmp_path / "profile.json")
+    with multiprocessing.Pool(4) as pool:
+        pool.map(write_profile, [(path, worker) for worker in range(4)])
+    assert len(autotune.load_profile(path)["host"]) == 200
+    assert not list(tmp_path.glob("*.tmp"))
+
+    # An unreadable profile is treated as empty:
+    with open(path, "w") as f:
+        f.write('{"host": {"1')
+    assert autotune.load_profile(path) == {}
+
+
+def test_selected_outputs():
+    img, _, _ = utils.generate_input(3)
+    ref = main.main(img, extensive=True)
+    res = main.main(img, outputs=["R", "GBD_h", "l_ON"])
+    assert sorted(res) == ["GBD_h", "R", "l_ON"]
+    assert np.array_equal(res["GBD_h"], ref["GBD_h"])
+    assert np.array_equal(res["l_ON"], ref["l_ON"])
+    P = boundary_detection.P
+    assert np.array_equal(res["R"], (ref["R_h"] + ref["R_v"])[P:-P, P:-P])
+    with pytest.raises(ValueError):
+        main.main(img, outputs=["R_sparse"])
+
+    pre = main.precompute(img)
+    bcs_ref = boundary_detection.BCS(pre["c_ON"], pre["c_OFF"], extensive=True,
+                                     maps=pre["boundary_maps"])
+    bcs_res = boundary_detection.BCS(pre["c_ON"], pre["c_OFF"], maps=pre["boundary_maps"],
+                                     outputs=["R_v", "GBD_v", "R_sparse"])
+    assert sorted(bcs_res) == ["GBD_v", "R_sparse", "R_v"]
+    assert np.array_equal(bcs_res["R_v"], bcs_ref["R_v"])
+    for key in ("shape", "indices", "values"):
+        assert np.array_equal(bcs_res["R_sparse"][key], bcs_ref["R_sparse"][key])
+    with pytest.raises(ValueError):
+        boundary_detection.BCS(pre["c_ON"], pre["c_OFF"], outputs=["M_ON"])